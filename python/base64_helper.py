@@ -22,12 +22,12 @@ def deserialize_file(filename, delimiter=','):
     creates a new file with deserialized content for every previously base64 encoded value.
     """
     output_file = ''.join([os.path.splitext(filename)[0], '_expanded.csv'])
-    with open(filename, 'r') as src:
-        with open(output_file, 'w') as dst:
+    with open(filename, 'r', newline='') as src:
+        with open(output_file, 'w', newline='') as dst:
             reader = csv.reader(src, delimiter=delimiter)
-            for tokens in reader:
-                dst.write(delimiter.join([deserialize(t) for t in tokens]))
-                dst.write('\n')
+            # csv.writer quotes any expanded value that now contains the delimiter
+            writer = csv.writer(dst, delimiter=delimiter, lineterminator='\n')
+            writer.writerows([deserialize(t) for t in tokens] for tokens in reader)
     return output_file
 
 if __name__ == "__main__":
@@ -1,39 +1,58 @@
 """
 implement a set that stores data on disk
 """
+import collections
+import hashlib
+import mmap
 import os
 import shutil
+import tempfile
 
 class FileSystemSet():
     data_directory_name = "FileSystemSetData"
     data_directory = data_directory_name
     max_files_per_directory = 1
     max_collisions_per_file = 1
-    tri_length = 0 # how long should directory path components be?
-    folder_depth = 1 # how many path components to use from the hash
+    num_buckets = 1 # how many directories the hashes are spread across
+    load_factor = 1.25 # keep the average directory this much below max_files_per_directory
+    max_open_files = 128 # how many append handles to keep around between writes
+    max_recent_files = 128 # how many files' worth of known keys to remember
 
     def __init__(self, directory):
+        self.owns_data_directory = False
+        self.file_counts = {} # how many hash files are in each directory?
+        self.total_files = 0
+        self.open_files = collections.OrderedDict() # path -> append handle, least recently used first
+        self.recent_keys = collections.OrderedDict() # path -> keys known to be in that file, least recently used first
+
+        # the set deletes its data directory when it goes away, so it must be one the set made itself.
+        #   mkdtemp picks a fresh name next to directory every time, so it never adopts (and later removes)
+        #   someone else's files, and a run that died before __del__ can't block the next one.
         self.data_directory_name = directory
-        self.data_directory = self.new_directory_name()
+        parent, name = os.path.split(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        self.data_directory = tempfile.mkdtemp(prefix=name + "_", dir=parent)
+        self.owns_data_directory = True
 
     def __del__(self):
-        self.cleanup(self.data_directory)
+        self.close_files()
+        if self.owns_data_directory:
+            self.cleanup(self.data_directory)
 
     def has(self, key):
         """
         return True if set contains key
         """
-        file_name = self.file_hash(key)
-        directory = self.file_dir(file_name, self.data_directory)
-        if not os.path.exists(os.path.join(directory, file_name)):
+        path = self.find_file(self.file_hash(key))
+        if path is None:
             return False
+        if self.recently_seen(path, key):
+            return True
 
-        with open(os.path.join(directory, file_name)) as f:
-            for l in f.readlines():
-                if key == l.rstrip():
-                    # we've seen this line before
-                    return False
-        return True
+        _, found = self.scan_file(path, key)
+        if found:
+            self.remember(path, [key])
+        return found
 
     def add(self, key):
         """
@@ -41,119 +60,413 @@ class FileSystemSet():
         return True if set mutated, False
         """
         file_name = self.file_hash(key)
-        directory = self.file_dir(file_name, self.data_directory)
+        for directory in self.probe(file_name):
+            path = os.path.join(directory, file_name)
 
-        if not os.path.exists(os.path.join(directory, file_name)):
-            # this is a new hash
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-            else:
-                # how many files are in this directory?
-                #   we may need to rebalance
-                count = 0
-                for f in os.scandir(directory):
-                    if f.is_file():
-                        count += 1
-                if count >= self.max_files_per_directory:
-                    # rebalance and try again with the update directory parameters
+            # how many files are in this directory?
+            count = self.file_counts.get(directory, 0)
+            if count < self.max_files_per_directory:
+                # there's room for a new hash, so try to create its file outright.
+                #   O_EXCL fails if the file already exists, which saves a separate exists check.
+                if not count:
+                    os.makedirs(directory, exist_ok=True)
+                try:
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                except FileExistsError:
+                    break
+                # this is a new hash
+                with os.fdopen(fd, 'w', encoding="utf-8") as new_file:
+                    new_file.write(key + "\n")
+                self.remember(path, [key])
+                self.file_counts[directory] = count + 1
+                self.total_files += 1
+                if self.overloaded(0):
                     self.rebalance()
-                    return self.add(key)
+                return True
 
-            # write new file
-            with open(os.path.join(directory, file_name), 'w') as new_file:
-                new_file.write(key + "\n")
+            if os.path.exists(path):
+                break
+            # the directory is full and doesn't have this hash -- forward to the next one
+        else:
+            # every bucket is full, which the load bound only allows when load_factor <= 1.
+            #   grow, then try again with the new bucket count
+            self.rebalance()
+            return self.add(key)
 
+        # we have a hash collision -- this might be a dup
+        if self.recently_seen(path, key):
+            return False
+        collision_count, found = self.scan_file(path, key)
+        if found:
+            # we've seen this line before
+            self.remember(path, [key])
+            return False
+
+        # append if possible
+        if collision_count < self.max_collisions_per_file:
+            # we're under the scan cap, so just append to the end
+            self.open_file(path).write(key + "\n") # add colliding line to end?
+            self.remember(path, [key])
         else:
-            # we have a hash collision -- this might be a dup
-            collision_count = 0
-            with open(os.path.join(directory, file_name)) as f:
-                for l in f.readlines():
-                    collision_count += 1
-                    if key == l.rstrip():
-                        # we've seen this line before
-                        return False
-
-            # append if possible
-            if collision_count < self.max_collisions_per_file:
-                # we're under the scan cap, so just append to the end
-                with open(os.path.join(directory, file_name), 'a') as f:
-                    f.write(key + "\n") # add colliding line to end?
-            else:
+            # we're over the scanning limit. there have been too many hash collisions.
+            raise Exception()
+
+        return True
+
+    def add_many(self, keys):
+        """
+        add every key in keys to set
+        return the keys that mutated the set, in order
+        """
+        # group keys by hash so every file is read and written at most once
+        buckets = {}
+        added = []
+        for key in keys:
+            file_name = self.file_hash(key)
+            bucket = buckets.get(file_name)
+            if bucket is None:
+                existing = []
+                path = self.find_file(file_name)
+                if path:
+                    self.flush_file(path)
+                    with open(path, encoding="utf-8") as f:
+                        existing = [l.rstrip("\n") for l in f]
+                buckets[file_name] = bucket = (existing, [])
+            existing, new_keys = bucket
+            if key in existing or key in new_keys:
+                continue # we've seen this line before
+            if len(existing) + len(new_keys) >= self.max_collisions_per_file:
                 # we're over the scanning limit. there have been too many hash collisions.
                 raise Exception()
+            new_keys.append(key)
+            added.append(key)
 
-        return True
+        # grow the directory structure once, up front, instead of once per overflowing add
+        new_files = sum(1 for existing, new_keys in buckets.values() if new_keys and not existing)
+        while self.overloaded(new_files):
+            self.rebalance()
+
+        # write each bucket with a single open
+        for file_name, (existing, new_keys) in buckets.items():
+            if not new_keys:
+                continue
+            if existing:
+                path = self.find_file(file_name) # rebalance may have moved it
+            else:
+                directory = self.free_dir(file_name)
+                if not self.file_counts.get(directory):
+                    os.makedirs(directory, exist_ok=True)
+                self.file_counts[directory] = self.file_counts.get(directory, 0) + 1
+                self.total_files += 1
+                path = os.path.join(directory, file_name)
+            self.open_file(path).write("".join(k + "\n" for k in new_keys))
+            self.remember(path, new_keys)
 
-    def new_directory_name(self):
-        return "_".join([
-            self.data_directory_name,
-            str(self.tri_length),
-            str(self.folder_depth)
-            ])
+        return added
 
-    def file_dir(self, file_name, root):
+    def scan_file(self, path, key):
         """
-        build a folder structure based on the file name
+        return (number of lines, True if key is one of them) for a hash file.
+        the file is memory-mapped and searched with find, so no string is built per line.
+        lines are only counted on a miss, and only up to self.max_collisions_per_file, since that's all add needs to know.
         """
-        sub_dirs = self.chunk(file_name, self.tri_length)[:self.folder_depth]
-        directory = os.path.join(root, *sub_dirs)
-        return directory
+        self.flush_file(path)
+        needle = key.encode("utf-8") + b"\n"
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return 0, False # mmap can't map an empty file
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # a hit only counts if it starts a line
+                i = mm.find(needle)
+                while i != -1:
+                    if i == 0 or mm[i - 1] == ord("\n"):
+                        return 0, True
+                    i = mm.find(needle, i + 1)
 
-    def file_hash(self, line):
-        return str(abs(hash(line)))
+                lines = 0
+                i = mm.find(b"\n")
+                while i != -1 and lines < self.max_collisions_per_file:
+                    lines += 1
+                    i = mm.find(b"\n", i + 1)
+                return lines, False
 
-    def rebalance(self):
+    def remember(self, path, keys):
+        """
+        note keys as being in the file at path, forgetting the least recently used file if we know too many
         """
-        ensure that no directory has more than self.max_files_per_directory files in it.
-        ensure that no file has more than self.max_collisions_per_file lines in it.
+        known = self.recent_keys.pop(path, None)
+        if known is None:
+            if len(self.recent_keys) >= self.max_recent_files:
+                self.recent_keys.popitem(last=False)
+            known = set()
+        known.update(keys)
+        self.recent_keys[path] = known
+
+    def recently_seen(self, path, key):
+        """
+        return True if key is known to be in the file at path, without reading it.
+        False only means we don't know.
         """
+        known = self.recent_keys.get(path)
+        return known is not None and key in known
 
-        # change directory generation function
-        self.tri_length += 1 # reduce chance of directory collision by 1/N, where N is base of the hash space? (10 for base-10 numeric hash)
-        # folder_depth += 1
+    def open_file(self, path):
+        """
+        return a cached append handle for path, closing the least recently used one if we have too many
+        """
+        f = self.open_files.pop(path, None)
+        if f is None:
+            if len(self.open_files) >= self.max_open_files:
+                _, oldest = self.open_files.popitem(last=False)
+                oldest.close()
+            f = open(path, 'a', buffering=8192, encoding="utf-8")
+        self.open_files[path] = f
+        return f
 
-        # change hash function?
-        changed_hash_function = False
+    def flush_file(self, path):
+        """
+        make buffered writes to path visible to readers
+        """
+        f = self.open_files.get(path)
+        if f:
+            f.flush()
 
+    def close_files(self):
+        for f in self.open_files.values():
+            f.close()
+        self.open_files.clear()
 
-        # new root directory
-        old_data_directory = self.data_directory
-        self.data_directory = self.new_directory_name()
+    def file_dir(self, file_name, root):
+        """
+        pick the home bucket directory for a hash with jump consistent hashing,
+        so adding buckets only moves the files that land in the new ones.
+        """
+        bucket = self.jump_hash(int(file_name, 16), self.num_buckets)
+        return os.path.join(root, str(bucket))
 
-        # restructure data to avoid massive lists of files per directory
-        for root, _, files in os.walk(old_data_directory):
-            for f in files:
-                if changed_hash_function:
-                    # f is a file that contains all the keys that hash to its name.
-                    # rehash them all with the new function
-                    with open(os.path.join(root, f)) as keys:
-                        for key in keys.readlines():
-                            self.add(key.rstrip())
-                else:
-                    # just move file of collisions to the new directory
-                    d = self.file_dir(f, self.data_directory)
-                    os.makedirs(d, exist_ok=True)
-                    shutil.move(
-                        src = os.path.join(root, f),
-                        dst = os.path.join(d, f)
-                        )
+    def probe(self, file_name):
+        """
+        yield the bucket directories a hash may live in: its home bucket,
+        then every following bucket, wrapping around.
+        a full bucket forwards new hashes to the next one instead of forcing a rebalance.
+        """
+        home = self.jump_hash(int(file_name, 16), self.num_buckets)
+        for i in range(self.num_buckets):
+            yield os.path.join(self.data_directory, str((home + i) % self.num_buckets))
 
-        # remove old data
-        self.cleanup(old_data_directory)
+    def find_file(self, file_name):
+        """
+        return the path of the file for this hash, or None.
+        hashes are only ever forwarded past full buckets, so the search stops at the first one with room.
+        """
+        for directory in self.probe(file_name):
+            path = os.path.join(directory, file_name)
+            if os.path.exists(path):
+                return path
+            if self.file_counts.get(directory, 0) < self.max_files_per_directory:
+                return None
+        return None
+
+    def free_dir(self, file_name):
+        """
+        return the first bucket directory along the probe with room for another file
+        """
+        for directory in self.probe(file_name):
+            if self.file_counts.get(directory, 0) < self.max_files_per_directory:
+                return directory
+        raise Exception()
 
-    def chunk(self, array, size):
+    def overloaded(self, new_files):
         """
-        split array into subarrays of length 'size'
+        would new_files more files push the average directory past max_files_per_directory / load_factor?
+        bounding the average keeps forwarding chains short.
+        a load_factor below 1 can't stretch the bound past what the buckets actually hold.
         """
-        if size < 1:
-            return []
+        capacity = self.num_buckets * self.max_files_per_directory
+        return self.total_files + new_files > capacity / max(self.load_factor, 1)
 
-        return [array[i:i+size] for i in range(0, len(array), size)]
+    def jump_hash(self, key, num_buckets):
+        """
+        map a 64 bit key to a bucket in [0, num_buckets).
+        Lamping & Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm"
+        """
+        b, j = -1, 0
+        while j < num_buckets:
+            b = j
+            key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+            j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+        return b
+
+    def file_hash(self, line):
+        """
+        fixed-width hex digest of line.
+        python's hash() is salted per process, so it can't name files that outlive the interpreter.
+        """
+        return hashlib.blake2b(line.encode("utf-8"), digest_size=8).hexdigest()
+
+    def rebalance(self):
+        """
+        grow the bucket space so the average directory is back under the load bound.
+        """
+
+        # grow the bucket space. jump hash only ever sends a file to one of the new buckets,
+        #   so everything else stays where it is.
+        #   doubling (rather than adding one bucket) keeps the number of rebalances logarithmic.
+        self.num_buckets *= 2
+
+        # files are about to move, so flush and drop every cached handle and path
+        self.close_files()
+        self.recent_keys.clear()
+
+        # files already in their home bucket stay put.
+        #   everything else (new home, or forwarded earlier) is placed again once the stayers are counted,
+        #   so nothing ends up forwarded past a bucket with room.
+        #   snapshot the listing first, since files are moving within the same tree
+        moving = []
+        for entry in list(self.iter_files(self.data_directory)):
+            src = os.path.dirname(entry.path)
+            if src == self.file_dir(entry.name, self.data_directory):
+                continue # this bucket didn't change
+            self.file_counts[src] -= 1
+            moving.append(entry)
+
+        for entry in moving:
+            d = self.free_dir(entry.name)
+            if not self.file_counts.get(d):
+                # first file to land here
+                os.makedirs(d, exist_ok=True)
+            # same filesystem, so a plain rename is enough
+            os.replace(
+                src = entry.path,
+                dst = os.path.join(d, entry.name)
+                )
+            self.file_counts[d] = self.file_counts.get(d, 0) + 1
+
+    def iter_files(self, root):
+        """
+        yield a DirEntry for every file under root.
+        scandir already knows each entry's type, so unlike os.walk this never stats.
+        """
+        if not os.path.exists(root):
+            return
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    yield entry
+                elif entry.is_dir(follow_symlinks=False):
+                    yield from self.iter_files(entry.path)
 
     def cleanup(self, root):
         if os.path.exists(root):
             shutil.rmtree(root)
 
+class AppendLogSet():
+    """
+    same idea, but every key goes into one append-only log file.
+    an in-memory index maps each key's digest to the offsets of its lines,
+    so add and has never stat, create, or scan bucket files.
+    """
+    buffer_size = 1 << 20 # write pending lines once this many bytes pile up
+
+    def __init__(self, path):
+        self.log = None # set first, so close() is safe if anything below fails
+        self.reader = None
+        self.path = path
+        self.index = {} # digest -> offsets of log lines with that digest
+        self.size = 0 # bytes in the log, including anything still pending
+
+        # rehydrate the index from an existing log
+        if os.path.exists(path):
+            torn = False
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # a write was cut off part way through this key, so it was never stored
+                        torn = True
+                        break
+                    self.index.setdefault(self.key_hash(line.rstrip(b"\n")), []).append(self.size)
+                    self.size += len(line)
+            if torn:
+                # drop the partial line, or the next append would be glued onto it
+                os.truncate(path, self.size)
+
+        # new lines collect in pending and reach the log in one os.write per buffer_size bytes
+        self.written = self.size # bytes already handed to the log
+        self.pending = bytearray()
+        self.log = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.reader = open(path, 'rb')
+
+    def __del__(self):
+        self.close()
+
+    def flush(self):
+        """
+        write every pending line to the log
+        """
+        view = memoryview(self.pending)
+        while view:
+            view = view[os.write(self.log, view):]
+        view.release()
+        self.pending.clear()
+        self.written = self.size
+
+    def close(self):
+        if self.log is None:
+            return
+        self.flush()
+        # fdatasync skips the metadata sync that fsync does, but macOS only has fsync
+        getattr(os, "fdatasync", os.fsync)(self.log)
+        os.close(self.log)
+        self.log = None
+        if self.reader:
+            self.reader.close()
+
+    def has(self, key):
+        """
+        return True if set contains key
+        """
+        data = key.encode("utf-8")
+        return self.contains(self.key_hash(data), data)
+
+    def add(self, key):
+        """
+        add key to set
+        return True if set mutated, False
+        """
+        data = key.encode("utf-8")
+        digest = self.key_hash(data)
+        if self.contains(digest, data):
+            return False
+
+        self.index.setdefault(digest, []).append(self.size)
+        self.pending += data
+        self.pending += b"\n"
+        self.size += len(data) + 1
+        if len(self.pending) >= self.buffer_size:
+            self.flush()
+        return True
+
+    def contains(self, digest, data):
+        offsets = self.index.get(digest)
+        if not offsets:
+            return False
+
+        # digests can collide, so compare against the logged lines themselves.
+        #   lines that haven't been written yet are still in pending, so there's no need to flush.
+        for offset in offsets:
+            if offset >= self.written:
+                start = offset - self.written
+                line = self.pending[start:self.pending.index(b"\n", start)]
+            else:
+                self.reader.seek(offset)
+                line = self.reader.readline().rstrip(b"\n")
+            if line == data:
+                return True
+        return False
+
+    def key_hash(self, data):
+        return hashlib.blake2b(data, digest_size=8).digest()
+
 if __name__ == "__main__":
 
     s = FileSystemSet("uniq")
@@ -1,34 +1,138 @@
 '''
 aggregate example
 '''
+
+group_ints_compiled = None # numba build of group_ints, made on first use. False if numba isn't installed
+int64_max = 2**63 - 1
+
 def aggregate(elements):
     '''
     collect stats for histogram-like use cases
+    elements is an iterable of (key, value) pairs, a pandas DataFrame whose first two columns are key and value,
+    or an (n, 2) integer numpy array of key, value rows
+    '''
+    if hasattr(elements, "columns"):
+        # the data is already a DataFrame, so let pandas group it
+        return aggregate_frame(elements)
+    if getattr(elements, "ndim", 0) == 2 and elements.dtype.kind in "iu":
+        return aggregate_ints(elements)
+    return aggregate_python(elements)
+
+def aggregate_python(elements):
     '''
-    data_collector = {}
+    one pass over elements in plain python
+    '''
+    # running stats per key as a [count, sum, min, max] row.
+    #   indexing a short list is cheaper than get/set on a dict of named fields.
+    rows = {}
     for key, value in elements:
-        # load state or hydrate
-        metadata = data_collector.get(key)
-        if not metadata:
-            data_collector[key] = metadata = {}
+        row = rows.get(key)
+        if row is None:
+            # the first value is the min and max so far, even when it's NaN
+            rows[key] = [1, value, value, value]
+            continue
+        row[0] += 1
+        row[1] += value
+        if value < row[2]:
+            row[2] = value
+        if value > row[3]:
+            row[3] = value
+
+    # name the fields once per key, not once per element
+    return {
+        key: {"count": c, "sum": s, "min": mn, "max": mx}
+        for key, (c, s, mn, mx) in rows.items()
+        }
+
+def aggregate_frame(frame):
+    '''
+    aggregate_python for a DataFrame, but the grouping runs in pandas' vectorized code.
+    the one difference is NaN values: pandas skips them in sum, min and max (they still count),
+    where the python loop carries a NaN into the sum.
+    '''
+    key, value = frame.columns[:2]
+    # "size" counts every row, like the python loop; pandas' "count" would skip NaN values
+    stats = frame.groupby(key, sort=False, dropna=False)[value].agg(["size", "sum", "min", "max"])
+
+    # tolist() hands back plain python numbers rather than numpy scalars.
+    #   pandas stores a None key as NaN, so map it back (NaN is the only value not equal to itself)
+    columns = [stats[c].tolist() for c in ("size", "sum", "min", "max")]
+    return {
+        k if k == k else None: {"count": c, "sum": s, "min": mn, "max": mx}
+        for k, c, s, mn, mx in zip(stats.index.tolist(), *columns)
+        }
 
-        # instances of key
-        count = metadata.get("count", 0)
-        metadata["count"] = count + 1
+def aggregate_ints(pairs):
+    '''
+    same result as aggregate_python for an (n, 2) integer numpy array.
+    the grouping loop is compiled with numba when it's installed.
+    '''
+    global group_ints_compiled
+    if group_ints_compiled is None:
+        try:
+            import numba
+        except ImportError:
+            group_ints_compiled = False # don't search for it again on every call
+        else:
+            group_ints_compiled = numba.njit(cache=True)(group_ints)
 
-        # sum of value
-        sum = metadata.get("sum", 0)
-        metadata["sum"] = sum + value
+    if not group_ints_compiled or overflows_int64(pairs):
+        # looping over numpy scalars in python is slower than over plain ints
+        return aggregate_python(pairs.tolist())
 
-        # min of value
-        min = metadata.get("min", value)
-        metadata["min"] = value if value < min else min
+    import numpy
+    keys = numpy.ascontiguousarray(pairs[:, 0], dtype=numpy.int64)
+    values = numpy.ascontiguousarray(pairs[:, 1], dtype=numpy.int64)
+    out_keys = numpy.empty_like(keys)
+    stats = numpy.empty((len(keys), 4), dtype=numpy.int64)
+    n = group_ints_compiled(keys, values, out_keys, stats)
+    return {
+        key: {"count": c, "sum": s, "min": mn, "max": mx}
+        for key, (c, s, mn, mx) in zip(out_keys[:n].tolist(), stats[:n].tolist())
+        }
 
-        # max of value
-        max = metadata.get("max", value)
-        metadata["max"] = value if value > max else max
+def overflows_int64(pairs):
+    '''
+    could a key, or a sum of values, in pairs fall outside int64?
+    the numba kernel keeps everything in int64, where that would wrap around silently.
+    '''
+    if not len(pairs):
+        return False
+    keys = pairs[:, 0]
+    values = pairs[:, 1]
+    if int(keys.max()) > int64_max: # only possible for uint64
+        return True
+    largest = max(abs(int(values.min())), abs(int(values.max())))
+    return largest * len(values) > int64_max
 
-    return data_collector
+def group_ints(keys, values, out_keys, stats):
+    '''
+    numba kernel for aggregate_ints.
+    each distinct key gets the next row of out_keys and stats ([count, sum, min, max]), in first-seen order.
+    returns the number of distinct keys.
+    '''
+    slots = dict()
+    n = 0
+    for i in range(keys.shape[0]):
+        key = keys[i]
+        value = values[i]
+        if key not in slots:
+            slots[key] = n
+            out_keys[n] = key
+            stats[n, 0] = 1
+            stats[n, 1] = value
+            stats[n, 2] = value
+            stats[n, 3] = value
+            n += 1
+        else:
+            slot = slots[key]
+            stats[slot, 0] += 1
+            stats[slot, 1] += value
+            if value < stats[slot, 2]:
+                stats[slot, 2] = value
+            if value > stats[slot, 3]:
+                stats[slot, 3] = value
+    return n
 
 d = aggregate((
     ("a", 1),
@@ -38,4 +142,4 @@ d = aggregate((
     ))
 
 for k, v in d.items():
-    print (k, v)
\ No newline at end of file
+    print (k, v)